@@ -14,6 +14,8 @@ import os
 import numba
 import numba.core.typing.cffi_utils as cffi_support
 import numpy
+from llvmlite import ir
+from numba.core import cgutils
 
 import cffi
 import dolfinx
@@ -22,10 +24,13 @@ import dolfinx.io
 import dolfinx.la
 import ufl
 from dolfinx.fem import locate_dofs_topological
-from dolfinx.mesh import locate_entities_boundary
 from mpi4py import MPI
 from petsc4py import PETSc
 
+# PETSc insert and scatter modes used for ghost updates
+ADD = PETSc.InsertMode.ADD
+REVERSE = PETSc.ScatterMode.REVERSE
+
 filedir = os.path.dirname(__file__)
 infile = dolfinx.io.XDMFFile(MPI.COMM_WORLD,
                              os.path.join(filedir, "cooks_tri_mesh.xdmf"),
@@ -38,29 +43,44 @@ infile.close()
 Se = ufl.TensorElement("DG", mesh.ufl_cell(), 1, symmetry=True)
 Ue = ufl.VectorElement("CG", mesh.ufl_cell(), 2)
 
-S = dolfinx.FunctionSpace(mesh, Se)
 U = dolfinx.FunctionSpace(mesh, Ue)
 
-# Get local dofmap sizes for later local tensor tabulations
-Ssize = S.dolfin_element().space_dimension()
+# Mixed stress-displacement space. It is only used to tabulate all
+# blocks needed for the condensation with a single (fused) kernel, so
+# no dofmap is required and a plain UFL function space suffices
+W = ufl.FunctionSpace(mesh.ufl_domain(), ufl.MixedElement([Se, Ue]))
+
+# Get local element dimensions for later local tensor tabulations. The
+# stress is eliminated cell-wise, so only its compiled UFC element is
+# needed and no stress function space (with a global dofmap) is created.
+# The dimensions are passed as constants to create_condensed_kernel below
+ufc_element_S, _ = dolfinx.jit.ffcx_jit(Se)
+Ssize = ufc_element_S.space_dimension
 Usize = U.dolfin_element().space_dimension()
 
-sigma, tau = ufl.TrialFunction(S), ufl.TestFunction(S)
-u, v = ufl.TrialFunction(U), ufl.TestFunction(U)
+sigma, u = ufl.TrialFunctions(W)
+tau, v = ufl.TestFunctions(W)
 
 
 def free_end(x):
     """Marks the leftmost points of the cantilever"""
-    return numpy.isclose(x[0], 48.0)
+    return numpy.abs(x[0] - 48.0) < 1.0e-8
 
 
 def left(x):
     """Marks left part of boundary, where cantilever is attached to wall"""
-    return numpy.isclose(x[0], 0.0)
+    return numpy.abs(x[0]) < 1.0e-8
+
 
+# Compute the boundary facets and their midpoints once, then locate the
+# facets at the free end and at the wall from these
+mesh.topology.create_entities(1)
+mesh.topology.create_connectivity(1, 2)
+boundary_facets = numpy.where(dolfinx.cpp.mesh.compute_boundary_facets(mesh.topology))[0].astype(numpy.int32)
+boundary_midpoints = dolfinx.cpp.mesh.midpoints(mesh, 1, boundary_facets).T
 
 # Locate all facets at the free end and assign them value 1
-free_end_facets = locate_entities_boundary(mesh, 1, free_end)
+free_end_facets = boundary_facets[free_end(boundary_midpoints)]
 mt = dolfinx.mesh.MeshTags(mesh, 1, free_end_facets, 1)
 
 ds = ufl.Measure("ds", subdomain_data=mt)
@@ -71,7 +91,7 @@ with u_bc.vector.localForm() as loc:
     loc.set(0.0)
 
 # Displacement BC is applied to the left side
-left_facets = locate_entities_boundary(mesh, 1, left)
+left_facets = boundary_facets[left(boundary_midpoints)]
 bdofs = locate_dofs_topological(U, 1, left_facets)
 bc = dolfinx.fem.DirichletBC(u_bc, bdofs)
 
@@ -91,53 +111,132 @@ a10 = - ufl.inner(sigma, ufl.grad(v)) * ufl.dx
 a01 = - ufl.inner(sigma_u(u), tau) * ufl.dx
 
 f = ufl.as_vector([0.0, 1.0 / 16])
-b1 = - ufl.inner(f, v) * ds(1)
+b1 = - ufl.inner(f, ufl.TestFunction(U)) * ds(1)
 
-# JIT compile individual blocks tabulation kernels
-ufc_form00 = dolfinx.jit.ffcx_jit(a00)
-kernel00 = ufc_form00.create_cell_integral(-1).tabulate_tensor
-
-ufc_form01 = dolfinx.jit.ffcx_jit(a01)
-kernel01 = ufc_form01.create_cell_integral(-1).tabulate_tensor
-
-ufc_form10 = dolfinx.jit.ffcx_jit(a10)
-kernel10 = ufc_form10.create_cell_integral(-1).tabulate_tensor
+# JIT compile a single kernel tabulating the blocks A00, A01 and A10 of
+# the mixed form in one pass over the quadrature points, so geometry and
+# basis function evaluations are shared between the blocks
+ufc_form = dolfinx.jit.ffcx_jit(a00 + a01 + a10)
+kernel = ufc_form.create_cell_integral(-1).tabulate_tensor
 
 ffi = cffi.FFI()
 
-cffi_support.register_type(ffi.typeof('double _Complex'),
-                           numba.types.complex128)
+# Numba scalar type of the kernels. The complex cffi type is only
+# registered for complex PETSc builds, real builds use plain float64
+# arithmetic throughout
+scalar_t = numba.typeof(PETSc.ScalarType())
+if dolfinx.common.has_petsc_complex:
+    cffi_support.register_type(ffi.typeof('double _Complex'),
+                               numba.types.complex128)
+
+
+@numba.extending.intrinsic
+def stack_empty(typingctx, m, n, dtype):
+    """Return a pointer to uninitialised stack memory for an ``m x n``
+    array of type ``dtype``. The shape must be compile-time constant,
+    so the memory is reserved once in the entry block of the calling
+    function rather than allocated on the heap for every call"""
+    if not (isinstance(m, numba.types.IntegerLiteral) and isinstance(n, numba.types.IntegerLiteral)):
+        raise numba.core.errors.TypingError("Shape of stack array must be compile-time constant")
+    size = m.literal_value * n.literal_value
+
+    def impl(context, builder, signature, args):
+        ty = context.get_value_type(dtype.dtype)
+        return cgutils.alloca_once(builder, ty, size=ir.Constant(ir.IntType(64), size))
+
+    sig = numba.types.CPointer(dtype.dtype)(m, n, dtype)
+    return sig, impl
+
+
+@numba.njit
+def cholesky_factor(A):
+    """Compute in-place Cholesky factorisation A = L L^H of the Hermitian
+    positive definite matrix A. The factor L is stored in the lower
+    triangle of A, the strictly upper triangle is not referenced"""
+    n = A.shape[0]
+    for j in range(n):
+        for k in range(j):
+            A[j, j] -= A[j, k] * numpy.conj(A[j, k])
+        A[j, j] = numpy.sqrt(A[j, j])
+        for i in range(j + 1, n):
+            for k in range(j):
+                A[i, j] -= A[i, k] * numpy.conj(A[j, k])
+            A[i, j] /= A[j, j]
+
+
+@numba.njit
+def cholesky_solve(L, B):
+    """Overwrite B with the solution X of L L^H X = B, where L is the
+    factor computed by cholesky_factor"""
+    n, m = B.shape
+    for c in range(m):
+        # Forward substitution with L
+        for i in range(n):
+            for j in range(i):
+                B[i, c] -= L[i, j] * B[j, c]
+            B[i, c] /= L[i, i]
+
+        # Backward substitution with L^H
+        for i in range(n - 1, -1, -1):
+            for j in range(i + 1, n):
+                B[i, c] -= numpy.conj(L[j, i]) * B[j, c]
+            B[i, c] /= numpy.conj(L[i, i])
+
 
 c_signature = numba.types.void(
-    numba.types.CPointer(numba.typeof(PETSc.ScalarType())),
-    numba.types.CPointer(numba.typeof(PETSc.ScalarType())),
-    numba.types.CPointer(numba.typeof(PETSc.ScalarType())),
+    numba.types.CPointer(scalar_t),
+    numba.types.CPointer(scalar_t),
+    numba.types.CPointer(scalar_t),
     numba.types.CPointer(numba.types.double),
     numba.types.CPointer(numba.types.int32),
     numba.types.CPointer(numba.types.uint8), numba.types.uint32)
 
 
-@numba.cfunc(c_signature, nopython=True)
-def tabulate_condensed_tensor_A(A_, w_, c_, coords_, entity_local_index, permutation=ffi.NULL,
-                                cell_permutation_info=0):
-    # Prepare target condensed local elem tensor
-    A = numba.carray(A_, (Usize, Usize), dtype=PETSc.ScalarType)
+def create_condensed_kernel(kernel, Ssize, Usize):
+    """Create a cell kernel tabulating the statically condensed tensor
+    from a kernel tabulating the mixed stress-displacement tensor.
 
-    # Tabulate all sub blocks locally
-    A00 = numpy.zeros((Ssize, Ssize), dtype=PETSc.ScalarType)
-    kernel00(ffi.from_buffer(A00), w_, c_, coords_, entity_local_index, permutation,
-             cell_permutation_info)
+    The local dimensions are captured as constants when the kernel is
+    compiled, so all buffer shapes and loop bounds are known to the
+    compiler and the small dense loops can be fully unrolled and
+    vectorised.
+    """
+    Wsize = Ssize + Usize
 
-    A01 = numpy.zeros((Ssize, Usize), dtype=PETSc.ScalarType)
-    kernel01(ffi.from_buffer(A01), w_, c_, coords_, entity_local_index, permutation,
-             cell_permutation_info)
+    @numba.cfunc(c_signature, nopython=True)
+    def tabulate_condensed_tensor_A(A_, w_, c_, coords_, entity_local_index, permutation=ffi.NULL,
+                                    cell_permutation_info=0):
+        # Prepare target condensed local elem tensor
+        A = numba.carray(A_, (Usize, Usize), dtype=PETSc.ScalarType)
 
-    A10 = numpy.zeros((Usize, Ssize), dtype=PETSc.ScalarType)
-    kernel10(ffi.from_buffer(A10), w_, c_, coords_, entity_local_index, permutation,
-             cell_permutation_info)
+        # Tabulate the mixed element tensor locally into a stack
+        # allocated (allocation free) buffer. The raw pointer is passed
+        # to the kernel, the array view is only used for linear algebra
+        Aw_ = stack_empty(Wsize, Wsize, PETSc.ScalarType)
+        Aw = numba.carray(Aw_, (Wsize, Wsize))
+        Aw[:] = 0.0
+        kernel(Aw_, w_, c_, coords_, entity_local_index, permutation, cell_permutation_info)
 
-    # A = - A10 * A00^{-1} * A01
-    A[:, :] = - A10 @ numpy.linalg.solve(A00, A01)
+        # Extract sub blocks, stress dofs come first in the mixed element
+        A00 = Aw[:Ssize, :Ssize]
+        A01 = Aw[:Ssize, Ssize:]
+        A10 = Aw[Ssize:, :Ssize]
+
+        # A = - A10 * A00^{-1} * A01, where A01 is overwritten by
+        # A00^{-1} * A01 to avoid a further buffer
+        cholesky_factor(A00)
+        cholesky_solve(A00, A01)
+        for i in range(Usize):
+            for j in range(Usize):
+                value = 0.0
+                for k in range(Ssize):
+                    value -= A10[i, k] * A01[k, j]
+                A[i, j] = value
+
+    return tabulate_condensed_tensor_A
+
+
+tabulate_condensed_tensor_A = create_condensed_kernel(kernel, Ssize, Usize)
 
 
 # Prepare an empty Form and set the condensed tabulation kernel
@@ -149,13 +248,14 @@ A_cond.assemble()
 
 b = dolfinx.fem.assemble_vector(b1)
 dolfinx.fem.apply_lifting(b, [a_cond], [[bc]])
-b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE)
+b.ghostUpdate(addv=ADD, mode=REVERSE)
 dolfinx.fem.set_bc(b, [bc])
 
 uc = dolfinx.Function(U)
 dolfinx.la.solve(A_cond, uc.vector, b)
 
 # Pure displacement based formulation
+u, v = ufl.TrialFunction(U), ufl.TestFunction(U)
 a = - ufl.inner(sigma_u(u), ufl.grad(v)) * ufl.dx
 A = dolfinx.fem.assemble_matrix(a, [bc])
 A.assemble()
@@ -163,16 +263,26 @@ A.assemble()
 # Create bounding box for function evaluation
 bb_tree = dolfinx.cpp.geometry.BoundingBoxTree(mesh, 2)
 
-# Check against standard table value
-p = numpy.array([48.0, 52.0, 0.0], dtype=numpy.float64)
-cell_candidates = dolfinx.cpp.geometry.compute_collisions_point(bb_tree, p)
-cell = dolfinx.cpp.geometry.select_colliding_cells(mesh, cell_candidates, p, 1)
-
-if len(cell) > 0:
-    value = uc.eval(p, cell)
-    print(value[1])
-    assert numpy.isclose(value[1], 23.95, rtol=1.e-2)
+# Check against standard table value. Cells colliding with the probe
+# points are located first, then the solution is evaluated at all points
+# found on this process with a single call
+points = numpy.array([[48.0, 52.0, 0.0]], dtype=numpy.float64)
+cells = numpy.full(points.shape[0], -1, dtype=numpy.int32)
+for i, p in enumerate(points):
+    cell_candidates = dolfinx.cpp.geometry.compute_collisions_point(bb_tree, p)
+    cell = dolfinx.cpp.geometry.select_colliding_cells(mesh, cell_candidates, p, 1)
+    if len(cell) > 0:
+        cells[i] = cell[0]
+
+found = cells >= 0
+if numpy.any(found):
+    values = uc.eval(points[found], cells[found]).reshape(numpy.count_nonzero(found), -1)
+    print(values[:, 1])
+    assert numpy.allclose(values[:, 1], 23.95, rtol=1.e-2)
 
 # Check the equality of displacement based and mixed condensed global
-# matrices, i.e. check that condensation is exact
-assert numpy.isclose((A - A_cond).norm(), 0.0)
+# matrices, i.e. check that condensation is exact. The difference is
+# formed in place in A (not needed any more), both matrices share the
+# same sparsity pattern
+A.axpy(-1.0, A_cond, structure=PETSc.Mat.Structure.SAME_NONZERO_PATTERN)
+assert numpy.isclose(A.norm(), 0.0)